@@ -1,76 +1,66 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import io
 import math
 import os
+import struct
 import sys
-import cv2
+import zlib
 import numpy as np
 
-from tempfile import NamedTemporaryFile
-
 from PIL import Image
 
 
 class FileReader(object):
-    def __init__(self, path_or_stream, file_backed=False):
-        self.tmpfile = None
+    def __init__(self, path_or_stream):
+        self.opened = False
         if hasattr(path_or_stream, "name") and path_or_stream.name != "<stdin>":
             self.length = os.path.getsize(path_or_stream.name)
             self.file = path_or_stream
             self.name = path_or_stream.name
+        elif isinstance(path_or_stream, str) and path_or_stream != "-" and os.path.isfile(path_or_stream):
+            # a regular file on disk can be read (or handed to PIL) directly, without buffering it in memory
+            self.length = os.path.getsize(path_or_stream)
+            self.file = open(path_or_stream, 'rb')
+            self.opened = True
+            self.name = path_or_stream
         else:
-            if sys.version_info.major >= 3:
-                file_mode = 'wb'
-                read_mode = 'rb'
-            else:
-                file_mode = 'w'
-                read_mode = 'r'
+            # stdin and paths that are not regular files (FIFOs, /dev/stdin, process substitution) have no
+            # meaningful size on disk, so they are buffered in memory
             if isinstance(path_or_stream, str) and path_or_stream != "-":
-                with open(path_or_stream, read_mode) as f:
+                with open(path_or_stream, 'rb') as f:
                     infile = f.read()
             elif sys.version_info.major >= 3:
                 infile = sys.stdin.buffer.read()
             else:
                 infile = sys.stdin.read()
             self.length = len(infile)
-            if file_backed:
-                tmp = NamedTemporaryFile(delete=False, mode=file_mode)
-                self.tmpfile = tmp.name
-                tmp.write(infile)
-                tmp.close()
-                self.file = open(self.tmpfile, read_mode)
-                self.name = self.tmpfile
-            else:
-                self.file = io.BytesIO(infile)
-                self.name = None
+            self.file = io.BytesIO(infile)
+            self.name = None
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.tmpfile is not None:
+        if self.opened:
             self.file.close()
-            os.unlink(self.tmpfile)
-            self.tmpfile = None
+            self.opened = False
             self.file = None
 
     @staticmethod
-    def new(path_or_stream, file_backed=False):
+    def new(path_or_stream):
         if isinstance(path_or_stream, FileReader):
             return path_or_stream
         else:
-            return FileReader(path_or_stream, file_backed=file_backed)
+            return FileReader(path_or_stream)
 
     def __len__(self):
         return self.length
 
     def read(self, n):
-        if sys.version_info.major >= 3:
-            return [i for i in self.file.read(n)]
-        else:
-            return map(ord, self.file.read(n))
+        return self.file.read(n)
 
 
 def choose_file_dimensions(infile, input_dimensions=None, square=False, verbose=False):
@@ -78,11 +68,18 @@ def choose_file_dimensions(infile, input_dimensions=None, square=False, verbose=
             and input_dimensions[1] is not None:
         # the dimensions were already fully specified
         return input_dimensions
-    infile = FileReader.new(infile)
-    num_bytes = len(infile)
-    num_pixels = int(math.ceil(float(num_bytes) / 3.0))
-    sqrt = math.sqrt(num_pixels)
-    sqrt_max = int(math.ceil(sqrt))
+    if isinstance(infile, FileReader):
+        num_bytes = len(infile)
+    else:
+        with FileReader(infile) as reader:
+            num_bytes = len(reader)
+    # integer arithmetic only: going through floats can be off by one for very large inputs
+    num_pixels = (num_bytes + 2) // 3
+    if num_pixels == 0:
+        raise Exception("Error: cannot encode an empty input as an image.")
+    sqrt_max = math.isqrt(num_pixels)
+    if sqrt_max * sqrt_max < num_pixels:
+        sqrt_max += 1
 
     if square is True:
         return sqrt_max, sqrt_max
@@ -101,20 +98,12 @@ def choose_file_dimensions(infile, input_dimensions=None, square=False, verbose=
             else:
                 return num_pixels // input_dimensions[1] + 1, input_dimensions[1]
 
-    best_dimensions = None
-    best_extra_bytes = None
-    for i in range(int(sqrt_max), 0, -1):
-        is_perfect = num_pixels % i == 0
-        if is_perfect:
-            dimensions = (i, num_pixels // i)
-        else:
-            dimensions = (i, num_pixels // i + 1)
-        extra_bytes = dimensions[0] * dimensions[1] * 3 - num_bytes
-        if dimensions[0] * dimensions[1] >= num_pixels and (best_dimensions is None or extra_bytes < best_extra_bytes):
-            best_dimensions = dimensions
-            best_extra_bytes = extra_bytes
-        if is_perfect:
-            break
+    # A width that divides the pixel count exactly always pads the least (only the 0-2 bytes needed to complete
+    # the last pixel), so the best dimensions come from the largest such width not exceeding the square root.
+    widths = np.arange(1, sqrt_max + 1, dtype=np.int64)
+    width = int(widths[num_pixels % widths == 0][-1])
+    best_dimensions = (width, num_pixels // width)
+    best_extra_bytes = num_pixels * 3 - num_bytes
     if best_extra_bytes > 0:
         if verbose is True:
             sys.stderr.write("Could not find PNG dimensions that perfectly encode "
@@ -123,96 +112,111 @@ def choose_file_dimensions(infile, input_dimensions=None, square=False, verbose=
     return best_dimensions
 
 
-def file_to_png(infile, outfile, dimensions=None, square=False, verbose=False, no_progress=False, use_lanczos=False):
-    reader = FileReader.new(infile)
-    dimensions = choose_file_dimensions(reader, dimensions, square=square, verbose=verbose)
-    dim = (int(dimensions[0]), int(dimensions[1]))
-    img = Image.new('RGB', dim)
-    pixels = img.load()
-    row = 0
-    column = -1
-    while True:
-        b = reader.read(3)
-        if not b:
-            break
-
-        column += 1
-        if column >= img.size[0]:
-            column = 0
-            row += 1
-            if no_progress is False:
-                percent = float(((row + 1) / dimensions[1]) * 100)
-                sys.stderr.write("\r%s%s" % (round(percent, 2), "%"))
-
-            if row >= img.size[1]:
-                raise Exception("Error: row %s is greater than maximum rows in image, %s." % (row, img.size[1]))
-
-        color = [b[0], 0, 0]
-        if len(b) > 1:
-            color[1] = b[1]
-        if len(b) > 2:
-            color[2] = b[2]
-
-        if not row >= img.size[1]:
-            pixels[column, row] = tuple(color)
-    if no_progress is False:
-        sys.stderr.write("\n")
+def write_png_chunk(outfile, chunk_type, data):
+    outfile.write(struct.pack(">I", len(data)))
+    outfile.write(chunk_type)
+    outfile.write(data)
+    outfile.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff))
+
+
+def parallel_zlib_pieces(data, level, threads=None):
+    # Each strip is deflated on its own thread (zlib releases the GIL). The first strip carries the zlib header,
+    # the rest are raw deflate; all but the last end on a sync flush, which leaves them byte-aligned, so the pieces
+    # concatenate into one valid stream once the Adler-32 of the whole input is appended. The pieces are returned
+    # as a list so callers can write them out one by one instead of joining them into another full-size copy.
+    threads = threads or os.cpu_count() or 1
+    strips = min(threads, len(data) // (1 << 20))
+    if strips <= 1:
+        return [zlib.compress(data, level)]
+    view = memoryview(data)
+    step = -(-len(data) // strips)
+    bounds = [(start, min(start + step, len(data))) for start in range(0, len(data), step)]
+
+    def compress_strip(bound):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 15 if bound[0] == 0 else -15)
+        flush_mode = zlib.Z_FINISH if bound[1] == len(data) else zlib.Z_SYNC_FLUSH
+        return compressor.compress(view[bound[0]:bound[1]]) + compressor.flush(flush_mode)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+        pieces = list(executor.map(compress_strip, bounds))
+    pieces.append(struct.pack(">I", zlib.adler32(data) & 0xffffffff))
+    return pieces
+
+
+def parallel_zlib_compress(data, level, threads=None):
+    return b"".join(parallel_zlib_pieces(data, level, threads=threads))
+
+
+def png_encode_raw(rgb_bytes, width, height, outfile, compress_level=1, threads=None):
+    # Arbitrary binary data gains next to nothing from PNG's row filters, so every row uses filter type 0 (None)
+    # and is deflated at a low zlib level (1 by default) instead of going through PIL's filter heuristic and level 6.
+    if width == 0 or height == 0:
+        raise Exception("Error: cannot encode an image of %sx%s pixels." % (width, height))
+    rows = np.frombuffer(rgb_bytes, dtype=np.uint8).reshape(height, width * 3)
+    filtered = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    filtered[:, 1:] = rows
+    # a flat view of the array, so the compressor slices bytes rather than rows and nothing is copied
+    pieces = parallel_zlib_pieces(filtered.reshape(-1), compress_level, threads=threads)
+
+    outfile.write(b"\x89PNG\r\n\x1a\n")
+    # 8 bits per sample, color type 2 (RGB), default compression and filter methods, no interlacing
+    write_png_chunk(outfile, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+    # the zlib stream may be split across IDAT chunks at any byte, so each piece is written as it is
+    for piece in pieces:
+        piece = memoryview(piece)
+        for start in range(0, len(piece), 1 << 20):
+            write_png_chunk(outfile, b"IDAT", piece[start:start + (1 << 20)])
+    write_png_chunk(outfile, b"IEND", b"")
+
+
+def file_to_png(infile, outfile, dimensions=None, square=False, verbose=False, no_progress=False, use_lanczos=False,
+                compress_level=1, threads=None):
+    with FileReader.new(infile) as reader:
+        dimensions = choose_file_dimensions(reader, dimensions, square=square, verbose=verbose)
+        dim = (int(dimensions[0]), int(dimensions[1]))
+        num_bytes = len(reader)
+        padding = dim[0] * dim[1] * 3 - num_bytes
+        if padding < 0:
+            raise Exception("Error: %s bytes do not fit in an image of %sx%s pixels." % (num_bytes, dim[0], dim[1]))
+
+        # Read the input straight into a buffer sized for the whole image; its zero-initialized tail is the padding.
+        rgb_bytes = bytearray(dim[0] * dim[1] * 3)
+        num_read = reader.file.readinto(memoryview(rgb_bytes)[:num_bytes])
+        if num_read != num_bytes:
+            raise Exception("Error: expected %s bytes of input but could only read %s." % (num_bytes, num_read))
 
     if sys.version_info.major >= 3 and outfile.name == '<stdout>' and hasattr(outfile, 'buffer'):
         outfile = outfile.buffer
-    img.save(outfile, format="PNG")
-
-    ######################## Lanczos addition ########################    
-    if use_lanczos:
-        # Convert PIL Image to OpenCV format
-        img_array = np.array(img)
-        img_opencv = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
-        target_size = (300, 300)
-    
-        # Resize using Lanczos
-        resized_img = cv2.resize(img_opencv, target_size, interpolation=cv2.INTER_LANCZOS4)
-        
-        # Convert back to RGB for PIL pipeline
-        resized_img_rgb = cv2.cvtColor(resized_img, cv2.COLOR_BGR2RGB)
-        img = Image.fromarray(resized_img_rgb)
-    ################################################################    
+
+    ######################## Lanczos addition ########################
+    if use_lanczos and dim != (300, 300):
+        # Resize using Lanczos before saving, so the resized image is what gets written. The full-size image
+        # shares the padded input buffer rather than copying it.
+        img = Image.frombuffer('RGB', dim, rgb_bytes, 'raw', 'RGB', 0, 1)
+        img = img.resize((300, 300), Image.LANCZOS)
+        img.save(outfile, format="PNG", compress_level=compress_level, optimize=False)
+        return
+    ################################################################
+
+    png_encode_raw(rgb_bytes, dim[0], dim[1], outfile, compress_level=compress_level, threads=threads)
+
 
 def png_to_file(infile, outfile, no_progress=False, verbose=False):
-    with FileReader.new(infile, file_backed=True) as reader:
-        img = Image.open(reader.name)
-        rgb_im = img.convert('RGB')
-
-        pix_buffer = 0
-        for row in range(img.size[1]):
-            if not no_progress:
-                percent = float(((row + 1) / img.size[1]) * 100)
-                sys.stderr.write("\r%s%s" % (round(percent, 2), "%"))
-            for col in range(img.size[0]):
-                pixel = rgb_im.getpixel((col, row))
-
-                # Omit the null bytes created in the generation of the image file.
-                # If it is a null byte, save it for later and see if there is going to be another null byte.
-                # If the original file ended in null bytes, it will omit those too, but there is
-                # probably no way to detect that.
-                for segment in pixel:
-                    if segment == 0:
-                        pix_buffer += 1
-                    else:
-                        if pix_buffer != 0:
-                            for color in range(pix_buffer):
-                                # flush the cache to the file if a non-null byte was detected
-                                if sys.version_info.major >= 3:
-                                    outfile.write(bytes([0]))
-                                else:
-                                    outfile.write(chr(0))
-                            pix_buffer = 0
-                        if sys.version_info.major >= 3:
-                            outfile.write(bytes([segment]))
-                        else:
-                            outfile.write(chr(segment))
-
-        if not no_progress:
-            sys.stderr.write("\n")
+    with FileReader.new(infile) as reader:
+        # PIL reads straight from the open file (or the in-memory stdin buffer); no temporary copy is needed
+        img = Image.open(reader.file)
+        # bin2png always writes RGB images, so the conversion (a full copy) is normally unnecessary
+        rgb_im = img if img.mode == 'RGB' else img.convert('RGB')
+
+        # Omit the null bytes created in the generation of the image file.
+        # If the original file ended in null bytes, it will omit those too, but there is
+        # probably no way to detect that.
+        data = np.asarray(rgb_im, dtype=np.uint8).reshape(-1)
+        nonzero = data[::-1] != 0
+        end = data.size - int(np.argmax(nonzero)) if nonzero.any() else 0
+        pix_buffer = data.size - end
+        outfile.write(memoryview(data[:end]))
+
         if pix_buffer != 0 and verbose:
             length = pix_buffer
             if length == 1:
@@ -221,6 +225,48 @@ def png_to_file(infile, outfile, no_progress=False, verbose=False):
                 sys.stderr.write("Omitting %s zeroes from end of file\n" % pix_buffer)
 
 
+def batch_convert(in_dir, out_dir, decode=False, max_workers=None, **kwargs):
+    # Encoding and decoding spend most of their time in zlib and NumPy, which release the GIL, so threads overlap
+    # one file's compression with another's I/O without paying interpreter startup per file.
+    # outputs are truncated before their input is read, so an output must never be one of the inputs
+    if os.path.realpath(in_dir) == os.path.realpath(out_dir):
+        raise Exception("Error: the batch output directory must differ from the input directory, %s." % in_dir)
+    jobs = []
+    for name in sorted(os.listdir(in_dir)):
+        in_path = os.path.join(in_dir, name)
+        if not os.path.isfile(in_path):
+            continue
+        if decode:
+            out_name = name[:-len(".png")] if name.lower().endswith(".png") else name
+        else:
+            out_name = name + ".png"
+        jobs.append((in_path, os.path.join(out_dir, out_name)))
+
+    inputs = set(os.path.realpath(in_path) for in_path, _ in jobs)
+    outputs = set()
+    for in_path, out_path in jobs:
+        real_out_path = os.path.realpath(out_path)
+        if real_out_path in inputs:
+            raise Exception("Error: converting %s would overwrite the input file %s." % (in_path, out_path))
+        if real_out_path in outputs:
+            raise Exception("Error: more than one input would be written to %s." % out_path)
+        outputs.add(real_out_path)
+    os.makedirs(out_dir, exist_ok=True)
+
+    def convert(job):
+        in_path, out_path = job
+        with open(out_path, 'wb') as outfile:
+            if decode:
+                png_to_file(in_path, outfile, **kwargs)
+            else:
+                # the pool already keeps every core busy, so each file is deflated on a single thread
+                file_to_png(in_path, outfile, threads=1, **kwargs)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        # consume the results so that an exception raised by any conversion propagates
+        list(executor.map(convert, jobs))
+
+
 def main(argv=None):
     parser = argparse.ArgumentParser(description="A simple cross-platform script for encoding any binary file into a "
                                                  "lossless PNG.", prog="bin2png")
@@ -233,7 +279,8 @@ def main(argv=None):
         out_default = sys.stdout
     parser.add_argument('file', nargs="?", default='-', type=str,
                         help="the file to encode as a PNG (defaults to '-', which is stdin)")
-    parser.add_argument("-o", "--outfile", type=argparse.FileType(write_mode), default=out_default,
+    # opened only once the arguments are known to be consistent, so a rejected command line never truncates it
+    parser.add_argument("-o", "--outfile", type=str, default='-',
                         help="the output file (defaults to '-', which is stdout)")
     parser.add_argument("-d", "--decode", action="store_true",
                         help="decodes the input PNG back to a file")
@@ -243,23 +290,55 @@ def main(argv=None):
                         help="constrain the output PNG to a specific height")
     parser.add_argument("-s", "--square", action="store_true", help="generate only square images")
     parser.add_argument("-v", "--verbose", action="store_true", help="enable debugging messages")
-    parser.add_argument("--no-progress", action="store_true", help="don't display percent progress")
+    parser.add_argument("--no-progress", action="store_true",
+                        help="don't display percent progress (accepted for compatibility; encoding and decoding "
+                             "are now done in a single pass and no longer report progress)")
+    parser.add_argument("--compress-level", type=int, default=1, choices=range(10), metavar="{0-9}",
+                        help="zlib compression level for the output PNG (defaults to 1; higher levels are much "
+                             "slower and rarely shrink arbitrary binary data)")
     parser.add_argument("--use-lanczos", action="store_true", help="use Lanczos interpolation and resize the image to 300x300")
+    parser.add_argument("--batch", nargs=2, metavar=("IN_DIR", "OUT_DIR"), default=None,
+                        help="convert every file in IN_DIR (encoding, or decoding with -d) into OUT_DIR in parallel")
 
     if argv is None:
         argv = sys.argv[1:]
 
     args = parser.parse_args(argv)
 
-    if args.decode:
-        png_to_file(args.file, args.outfile, no_progress=args.no_progress, verbose=args.verbose)
-    else:
-        dims = None
-        if args.height is not None or args.width is not None:
-            dims = (args.width, args.height)
+    dims = None
+    if args.height is not None or args.width is not None:
+        dims = (args.width, args.height)
+
+    if args.batch is not None:
+        if args.file != '-':
+            parser.error("a file argument cannot be combined with --batch")
+        if args.outfile != '-':
+            parser.error("-o/--outfile cannot be combined with --batch")
+        if args.decode:
+            batch_convert(args.batch[0], args.batch[1], decode=True, no_progress=args.no_progress,
+                          verbose=args.verbose)
+        else:
+            batch_convert(args.batch[0], args.batch[1], dimensions=dims, square=args.square, verbose=args.verbose,
+                          no_progress=args.no_progress, use_lanczos=args.use_lanczos,
+                          compress_level=args.compress_level)
+        return
 
-        file_to_png(args.file, args.outfile, dimensions=dims, square=args.square, verbose=args.verbose,
-                   no_progress=args.no_progress, use_lanczos=args.use_lanczos)
+    if args.outfile == '-':
+        outfile = out_default
+    else:
+        try:
+            outfile = open(args.outfile, write_mode)
+        except (IOError, OSError) as e:
+            parser.error("argument -o/--outfile: can't open '%s': %s" % (args.outfile, e))
+    try:
+        if args.decode:
+            png_to_file(args.file, outfile, no_progress=args.no_progress, verbose=args.verbose)
+        else:
+            file_to_png(args.file, outfile, dimensions=dims, square=args.square, verbose=args.verbose,
+                        no_progress=args.no_progress, use_lanczos=args.use_lanczos, compress_level=args.compress_level)
+    finally:
+        if outfile is not out_default:
+            outfile.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,115 @@
+import io
+import os
+import tempfile
+import unittest
+import zlib
+
+from PIL import Image
+
+import bin2png_lanczos
+
+
+class ChooseFileDimensionsTest(unittest.TestCase):
+    def test_empty_input(self):
+        with tempfile.NamedTemporaryFile() as f:
+            for kwargs in ({}, {"square": True}, {"input_dimensions": (10, None)}):
+                with self.assertRaisesRegex(Exception, "^Error: "):
+                    bin2png_lanczos.choose_file_dimensions(f.name, **kwargs)
+
+
+class ParallelZlibCompressTest(unittest.TestCase):
+    def test_round_trip(self):
+        # a few MiB so the data is actually split into several strips, half random and half zeros
+        data = os.urandom(3 << 19) + b"\x00" * ((3 << 19) + 7)
+        for level in (0, 1, 5, 6, 9):
+            for threads in (1, 2, 3, 8):
+                compressed = bin2png_lanczos.parallel_zlib_compress(data, level, threads=threads)
+                self.assertEqual(zlib.decompress(compressed), data, "level %s, %s threads" % (level, threads))
+
+    def test_small_input(self):
+        for data in (b"", b"bin2png"):
+            self.assertEqual(zlib.decompress(bin2png_lanczos.parallel_zlib_compress(data, 1, threads=4)), data)
+
+
+class PngRoundTripTest(unittest.TestCase):
+    def test_multi_threaded_encode(self):
+        data = os.urandom((3 << 20) + 5) + b"\x01"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            in_path = os.path.join(tmpdir, "input.bin")
+            png_path = os.path.join(tmpdir, "input.png")
+            with open(in_path, "wb") as f:
+                f.write(data)
+            with open(png_path, "wb") as outfile:
+                bin2png_lanczos.file_to_png(in_path, outfile, threads=4)
+
+            with Image.open(png_path) as img:
+                self.assertEqual(img.mode, "RGB")
+                pixels = img.tobytes()
+            self.assertEqual(pixels[:len(data)], data)
+            self.assertEqual(pixels[len(data):].strip(b"\x00"), b"")
+
+            decoded = io.BytesIO()
+            bin2png_lanczos.png_to_file(png_path, decoded)
+            self.assertEqual(decoded.getvalue(), data)
+
+
+class BatchConvertTest(unittest.TestCase):
+    def test_round_trip(self):
+        inputs = {"empty-tail": b"bin2png\x01", "random.bin": os.urandom(10000) + b"\xff", "one": b"\x01"}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            in_dir = os.path.join(tmpdir, "in")
+            png_dir = os.path.join(tmpdir, "png")
+            out_dir = os.path.join(tmpdir, "out")
+            os.mkdir(in_dir)
+            for name, data in inputs.items():
+                with open(os.path.join(in_dir, name), "wb") as f:
+                    f.write(data)
+
+            bin2png_lanczos.batch_convert(in_dir, png_dir)
+            self.assertEqual(sorted(os.listdir(png_dir)), sorted(name + ".png" for name in inputs))
+            bin2png_lanczos.batch_convert(png_dir, out_dir, decode=True)
+            for name, data in inputs.items():
+                with open(os.path.join(out_dir, name), "rb") as f:
+                    self.assertEqual(f.read(), data)
+
+    def test_outfile_is_not_truncated_when_rejected(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            keep_path = os.path.join(tmpdir, "keep.bin")
+            with open(keep_path, "wb") as f:
+                f.write(b"keep")
+            with self.assertRaises(SystemExit):
+                bin2png_lanczos.main(["--batch", tmpdir, os.path.join(tmpdir, "out"), "-o", keep_path])
+            with open(keep_path, "rb") as f:
+                self.assertEqual(f.read(), b"keep")
+
+    def test_same_directory_is_rejected(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # a PNG without the .png suffix decodes to its own name
+            png_path = os.path.join(tmpdir, "c")
+            with open(png_path, "wb") as outfile:
+                bin2png_lanczos.file_to_png(__file__, outfile)
+            with open(png_path, "rb") as f:
+                encoded = f.read()
+
+            with self.assertRaises(Exception):
+                bin2png_lanczos.batch_convert(tmpdir, os.path.join(tmpdir, "."), decode=True)
+            with open(png_path, "rb") as f:
+                self.assertEqual(f.read(), encoded)
+
+    def test_colliding_outputs_are_rejected(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            in_dir = os.path.join(tmpdir, "in")
+            out_dir = os.path.join(tmpdir, "out")
+            os.mkdir(in_dir)
+            for name in ("a", "a.png"):
+                with open(os.path.join(in_dir, name), "wb") as outfile:
+                    bin2png_lanczos.file_to_png(__file__, outfile)
+
+            # both "a" and "a.png" decode to "a"
+            with self.assertRaises(Exception):
+                bin2png_lanczos.batch_convert(in_dir, out_dir, decode=True)
+            self.assertFalse(os.path.exists(out_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()